@@ -16,15 +16,48 @@ import threading
 import time
 from pathlib import Path
 
-from prometheus_client import start_http_server, REGISTRY
+try:
+    import orjson  # ~3x faster than stdlib json on loads; optional at runtime
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson  # SIMD-accelerated lazy JSON parser; optional at runtime
+except ImportError:
+    simdjson = None
+
+from prometheus_client import (
+    GC_COLLECTOR,
+    PLATFORM_COLLECTOR,
+    PROCESS_COLLECTOR,
+    REGISTRY,
+    start_http_server,
+)
 from prometheus_client.core import GaugeMetricFamily
 
+# Reusable simdjson parser — reusing one instance avoids re-allocating its
+# internal buffers on every scrape. A parsed document is only valid until the
+# next parse() call, but scrapes are serialised by _speedtest_lock and
+# parse_metrics converts everything to plain Python values before returning.
+_SJ = simdjson.Parser() if simdjson else None
+
+
+def _json_loads(raw: str | bytes) -> dict:
+    """Parse a JSON blob with orjson when available, stdlib json otherwise."""
+    if orjson is not None:
+        return orjson.loads(raw if isinstance(raw, (bytes, bytearray)) else raw.encode())
+    return json.loads(raw)
+
 # ── Configuration ─────────────────────────────────────────────────────────────
 
 SERVER_ID   = os.environ.get("SERVER_ID", "").strip()
 FIRST_START = Path("/first_start")
 PORT        = 9142
 
+# Scrapes queued behind a running speedtest reuse its result if it finished
+# within this many seconds, instead of immediately running another test.
+COALESCE_WINDOW = 5.0
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s - %(levelname)s - %(message)s",
@@ -35,10 +68,11 @@ log = logging.getLogger(__name__)
 
 # ── Speedtest execution ───────────────────────────────────────────────────────
 
-def run_speedtest() -> dict | None:
+def run_speedtest() -> bytes | None:
     """
-    Run the Ookla speedtest CLI and return parsed JSON results.
+    Run the Ookla speedtest CLI and return its raw JSON output as bytes.
     Handles first-run license/GDPR acceptance automatically.
+    Parsing is deferred to parse_metrics, which can use lazy field access.
     Returns None on any failure.
     """
     first_run = not FIRST_START.exists()
@@ -57,52 +91,35 @@ def run_speedtest() -> dict | None:
     start_time = time.time()
 
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
+        # text=False keeps stdout as bytes — the JSON parsers take bytes
+        # directly, so decoding the whole buffer to str would be wasted work.
+        result = subprocess.run(cmd, capture_output=True, text=False, timeout=120)
         elapsed = time.time() - start_time
-        raw = result.stdout
+        raw: bytes = result.stdout
 
         if first_run:
             # License preamble appears before the JSON object on first run.
             # Locate the JSON by finding the first '{' rather than relying on
             # a fixed line count (more robust across CLI versions).
-            json_start = raw.find("{")
+            json_start = raw.find(b"{")
             if json_start == -1:
                 log.error("No JSON found in speedtest output on first run.")
-                log.error("stdout: %s", raw[:500])
-                log.error("stderr: %s", result.stderr[:500])
+                log.error("stdout: %s", raw[:500].decode("utf-8", "replace"))
+                log.error("stderr: %s", result.stderr[:500].decode("utf-8", "replace"))
                 return None
-            raw = raw[json_start:]
+            if json_start:
+                # Slice only when a preamble is actually present — raw[0:]
+                # would copy the whole buffer for nothing.
+                raw = raw[json_start:]
             FIRST_START.touch()
             log.info("First run complete. Ookla license and GDPR accepted.")
 
-        data = json.loads(raw)
-
         log.info("Speedtest complete in %.1fs.", elapsed)
-        log.info(
-            "Server: %s (%s) | ISP: %s",
-            data.get("server", {}).get("name", "unknown"),
-            data.get("server", {}).get("location", "unknown"),
-            data.get("isp", "unknown"),
-        )
-        log.info(
-            "Results: Download=%.2f Mbps | Upload=%.2f Mbps | Ping=%.2f ms | Jitter=%.2f ms",
-            (data["download"]["bandwidth"] * 8) / 1_000_000,
-            (data["upload"]["bandwidth"] * 8) / 1_000_000,
-            data["ping"]["latency"],
-            data["ping"]["jitter"],
-        )
-        if "packetLoss" in data:
-            log.info("Packet loss: %.2f%%", data["packetLoss"])
-
-        return data
+        return raw
 
     except subprocess.TimeoutExpired:
         log.error("Speedtest timed out after 120 seconds.")
         return None
-    except json.JSONDecodeError as exc:
-        log.error("Failed to parse speedtest JSON: %s", exc)
-        log.error("Raw output: %s", raw[:500] if "raw" in locals() else "unavailable")
-        return None
     except Exception as exc:
         log.error("Unexpected error running speedtest: %s", exc)
         return None
@@ -110,17 +127,26 @@ def run_speedtest() -> dict | None:
 
 # ── Metrics parsing ───────────────────────────────────────────────────────────
 
-def parse_metrics(data: dict) -> dict:
+def parse_metrics(raw: str | bytes) -> dict:
     """
-    Extract metrics from speedtest JSON and convert units.
+    Parse speedtest JSON and extract metrics, converting units.
     Bandwidth is converted from bytes/s to Mbps (SI: * 8 / 1,000,000).
+    Uses simdjson's lazy parser when available, so only the fields read
+    below are materialised as Python objects; falls back to orjson/stdlib.
     Returns an empty dict on parse failure.
     """
     def to_mbps(bps: float) -> float:
-        return round((bps * 8) / 1_000_000, 2)
+        # No rounding — Prometheus takes the float as-is; truncate in
+        # PromQL/dashboards if two decimals are wanted.
+        return bps * 8e-6
 
     try:
-        return {
+        if _SJ is not None:
+            data = _SJ.parse(raw if isinstance(raw, (bytes, bytearray)) else raw.encode())
+        else:
+            data = _json_loads(raw)
+
+        m = {
             # Ping
             "ping_latency_ms":              data["ping"]["latency"],
             "ping_jitter_ms":               data["ping"]["jitter"],
@@ -156,19 +182,70 @@ def parse_metrics(data: dict) -> dict:
             "timestamp":                    time.time(),
             "success":                      1.0,
         }
-    except (KeyError, TypeError) as exc:
-        log.error("Failed to parse metrics from speedtest data: %s", exc)
+
+        # Drop the simdjson document before returning — it is only valid
+        # until the parser's next parse() call.
+        del data
+
+        log.info("Server: %s (%s) | ISP: %s", m["server_name"], m["server_location"], m["isp"])
+        log.info(
+            "Results: Download=%.2f Mbps | Upload=%.2f Mbps | Ping=%.2f ms | Jitter=%.2f ms",
+            m["download_mbps"], m["upload_mbps"], m["ping_latency_ms"], m["ping_jitter_ms"],
+        )
+        if m["packet_loss"] is not None:
+            log.info("Packet loss: %.2f%%", m["packet_loss"])
+
+        return m
+
+    except (ValueError, KeyError, TypeError) as exc:
+        # ValueError covers JSON decode errors from all three parsers.
+        log.error("Failed to parse metrics from speedtest output: %s", exc)
+        snippet = raw[:500]
+        log.error("Raw output: %s", snippet.decode("utf-8", "replace") if isinstance(snippet, bytes) else snippet)
         return {}
 
 
 # ── Prometheus collector ──────────────────────────────────────────────────────
 
+# Label names for the speedtest_info metric. A module-level tuple of
+# literals: allocated once, and the strings are interned at compile time.
+_INFO_LABELS = ("server_id", "server_host", "server_name", "server_location",
+                "server_country", "isp", "external_ip")
+
+# Numeric metric specs: (metric name, help text, parse_metrics key).
+# Built once at import time — the table is immutable and identical per scrape.
+_SPECS = (
+    # Ping
+    ("speedtest_ping_latency_ms",              "Ping latency in milliseconds",                  "ping_latency_ms"),
+    ("speedtest_ping_jitter_ms",               "Ping jitter in milliseconds",                   "ping_jitter_ms"),
+    ("speedtest_ping_low_ms",                  "Ping low in milliseconds",                      "ping_low_ms"),
+    ("speedtest_ping_high_ms",                 "Ping high in milliseconds",                     "ping_high_ms"),
+    # Download
+    ("speedtest_download_bandwidth_mbps",      "Download bandwidth in Mbps",                    "download_mbps"),
+    ("speedtest_download_bytes",               "Total bytes received during download test",      "download_bytes"),
+    ("speedtest_download_elapsed_ms",          "Download test duration in milliseconds",         "download_elapsed_ms"),
+    ("speedtest_download_latency_iqm_ms",      "Download latency IQM in milliseconds",          "download_latency_iqm_ms"),
+    ("speedtest_download_latency_low_ms",      "Download latency low in milliseconds",          "download_latency_low_ms"),
+    ("speedtest_download_latency_high_ms",     "Download latency high in milliseconds",         "download_latency_high_ms"),
+    ("speedtest_download_latency_jitter_ms",   "Download latency jitter in milliseconds",       "download_latency_jitter_ms"),
+    # Upload
+    ("speedtest_upload_bandwidth_mbps",        "Upload bandwidth in Mbps",                      "upload_mbps"),
+    ("speedtest_upload_bytes",                 "Total bytes sent during upload test",            "upload_bytes"),
+    ("speedtest_upload_elapsed_ms",            "Upload test duration in milliseconds",           "upload_elapsed_ms"),
+    ("speedtest_upload_latency_iqm_ms",        "Upload latency IQM in milliseconds",            "upload_latency_iqm_ms"),
+    ("speedtest_upload_latency_low_ms",        "Upload latency low in milliseconds",            "upload_latency_low_ms"),
+    ("speedtest_upload_latency_high_ms",       "Upload latency high in milliseconds",           "upload_latency_high_ms"),
+    ("speedtest_upload_latency_jitter_ms",     "Upload latency jitter in milliseconds",         "upload_latency_jitter_ms"),
+)
+
 # Lock and shared result — ensures only one speedtest runs at a time.
 # Concurrent scrapes block until the in-progress test finishes,
 # then all return the same result without triggering another run.
 _speedtest_lock    = threading.Lock()
 _speedtest_running = False   # True while a test is actively in progress
 _last_result: dict | None = None
+_result_generation = 0       # bumped after every completed speedtest
+_last_finish_ts    = 0.0     # when the last speedtest finished
 
 
 class SpeedtestCollector:
@@ -182,28 +259,31 @@ class SpeedtestCollector:
         yield from self._build_metric_families(self._collect())
 
     def _collect(self) -> dict:
-        global _last_result, _speedtest_running
+        global _last_result, _speedtest_running, _result_generation, _last_finish_ts
 
-        was_waiting = _speedtest_running
-        if was_waiting:
+        # Snapshot the generation before queueing on the lock. If it has
+        # moved on by the time we acquire the lock, a test completed while
+        # we waited and we can reuse its result.
+        gen_on_entry = _result_generation
+        if _speedtest_running:
             log.info("Scrape requested while a speedtest is already in progress — waiting for it to finish...")
 
         with _speedtest_lock:
-            # If we were waiting and a result is now available, return it
-            # directly rather than kicking off another speedtest.
-            if was_waiting and _last_result is not None:
-                log.info("Returning result from completed speedtest to queued scrape.")
+            if (_result_generation != gen_on_entry
+                    and _last_result is not None
+                    and time.time() - _last_finish_ts < COALESCE_WINDOW):
+                log.info("Returning result from just-completed speedtest to queued scrape.")
                 return _last_result
 
             _speedtest_running = True
             log.info("Prometheus scrape received — running speedtest now...")
             try:
-                data = run_speedtest()
-                if data is None:
+                raw = run_speedtest()
+                if raw is None:
                     log.error("Speedtest failed — returning scrape_success=0.")
                     _last_result = {"success": 0.0, "timestamp": time.time()}
                 else:
-                    _last_result = parse_metrics(data)
+                    _last_result = parse_metrics(raw)
                     if not _last_result:
                         log.error("Metric parsing failed — returning scrape_success=0.")
                         _last_result = {"success": 0.0, "timestamp": time.time()}
@@ -211,6 +291,8 @@ class SpeedtestCollector:
                         log.info("Metrics parsed successfully — serving to Prometheus.")
             finally:
                 _speedtest_running = False
+                _result_generation += 1
+                _last_finish_ts = time.time()
             return _last_result
 
     @staticmethod
@@ -218,13 +300,16 @@ class SpeedtestCollector:
         success = m.get("success", 0.0)
         ts      = m.get("timestamp", 0.0)
 
-        g = GaugeMetricFamily("speedtest_scrape_success",
-                              "1 if the last speedtest run succeeded, 0 if it failed")
+        # Cache the constructor in a local — skips a LOAD_GLOBAL per metric.
+        G = GaugeMetricFamily
+
+        g = G("speedtest_scrape_success",
+              "1 if the last speedtest run succeeded, 0 if it failed")
         g.add_metric([], success)
         yield g
 
-        g = GaugeMetricFamily("speedtest_last_run_timestamp",
-                              "Unix timestamp of the last speedtest run")
+        g = G("speedtest_last_run_timestamp",
+              "Unix timestamp of the last speedtest run")
         g.add_metric([], ts)
         yield g
 
@@ -232,53 +317,23 @@ class SpeedtestCollector:
             return
 
         # ── Numeric metrics ───────────────────────────────────────────────────
-        specs = [
-            # Ping
-            ("speedtest_ping_latency_ms",              "Ping latency in milliseconds",                  "ping_latency_ms"),
-            ("speedtest_ping_jitter_ms",               "Ping jitter in milliseconds",                   "ping_jitter_ms"),
-            ("speedtest_ping_low_ms",                  "Ping low in milliseconds",                      "ping_low_ms"),
-            ("speedtest_ping_high_ms",                 "Ping high in milliseconds",                     "ping_high_ms"),
-            # Download
-            ("speedtest_download_bandwidth_mbps",      "Download bandwidth in Mbps",                    "download_mbps"),
-            ("speedtest_download_bytes",               "Total bytes received during download test",      "download_bytes"),
-            ("speedtest_download_elapsed_ms",          "Download test duration in milliseconds",         "download_elapsed_ms"),
-            ("speedtest_download_latency_iqm_ms",      "Download latency IQM in milliseconds",          "download_latency_iqm_ms"),
-            ("speedtest_download_latency_low_ms",      "Download latency low in milliseconds",          "download_latency_low_ms"),
-            ("speedtest_download_latency_high_ms",     "Download latency high in milliseconds",         "download_latency_high_ms"),
-            ("speedtest_download_latency_jitter_ms",   "Download latency jitter in milliseconds",       "download_latency_jitter_ms"),
-            # Upload
-            ("speedtest_upload_bandwidth_mbps",        "Upload bandwidth in Mbps",                      "upload_mbps"),
-            ("speedtest_upload_bytes",                 "Total bytes sent during upload test",            "upload_bytes"),
-            ("speedtest_upload_elapsed_ms",            "Upload test duration in milliseconds",           "upload_elapsed_ms"),
-            ("speedtest_upload_latency_iqm_ms",        "Upload latency IQM in milliseconds",            "upload_latency_iqm_ms"),
-            ("speedtest_upload_latency_low_ms",        "Upload latency low in milliseconds",            "upload_latency_low_ms"),
-            ("speedtest_upload_latency_high_ms",       "Upload latency high in milliseconds",           "upload_latency_high_ms"),
-            ("speedtest_upload_latency_jitter_ms",     "Upload latency jitter in milliseconds",         "upload_latency_jitter_ms"),
-        ]
-        for name, help_text, key in specs:
-            g = GaugeMetricFamily(name, help_text)
+        for name, help_text, key in _SPECS:
+            g = G(name, help_text)
             g.add_metric([], m[key])
             yield g
 
         # packet_loss is only emitted when the server reports it
         if m.get("packet_loss") is not None:
-            g = GaugeMetricFamily("speedtest_packet_loss", "Packet loss percentage")
+            g = G("speedtest_packet_loss", "Packet loss percentage")
             g.add_metric([], m["packet_loss"])
             yield g
 
         # ── Info metric ───────────────────────────────────────────────────────
         # Carries all string-valued identifier fields as labels.
-        info_labels     = ["server_id", "server_host", "server_name", "server_location", "server_country", "isp", "external_ip"]
-        info_label_vals = [m.get("server_id", "unknown"),
-                           m.get("server_host", "unknown"),
-                           m.get("server_name", "unknown"),
-                           m.get("server_location", "unknown"),
-                           m.get("server_country", "unknown"),
-                           m.get("isp", "unknown"),
-                           m.get("external_ip", "unknown")]
-        g = GaugeMetricFamily("speedtest_info",
-                              "Speedtest result metadata (server_id, server_host, server_name, server_location, server_country, isp, external_ip)",
-                              labels=info_labels)
+        info_label_vals = [m.get(label, "unknown") for label in _INFO_LABELS]
+        g = G("speedtest_info",
+              "Speedtest result metadata (server_id, server_host, server_name, server_location, server_country, isp, external_ip)",
+              labels=_INFO_LABELS)
         g.add_metric(info_label_vals, 1.0)
         yield g
 
@@ -287,12 +342,11 @@ class SpeedtestCollector:
 
 def main() -> None:
     # Remove default collectors (GC, Process, Platform) for focused output
-    for collector in list(REGISTRY._names_to_collectors.values()):
-        if type(collector).__name__ in ("GCCollector", "PlatformCollector", "ProcessCollector"):
-            try:
-                REGISTRY.unregister(collector)
-            except Exception:
-                pass
+    for collector in (GC_COLLECTOR, PLATFORM_COLLECTOR, PROCESS_COLLECTOR):
+        try:
+            REGISTRY.unregister(collector)
+        except KeyError:
+            pass  # already unregistered
 
     REGISTRY.register(SpeedtestCollector())
 
@@ -307,8 +361,13 @@ def main() -> None:
     log.info("Prometheus exporter listening on :%d", PORT)
     log.info("Each Prometheus scrape will trigger a live speedtest (~20-40s).")
 
-    while True:
-        time.sleep(10)
+    # Block in the kernel until a signal arrives — no periodic wakeups.
+    # _shutdown raises SystemExit, which unwinds cleanly from either call.
+    if hasattr(signal, "pause"):
+        signal.pause()
+    else:
+        # Windows has no signal.pause(); an unset Event blocks forever.
+        threading.Event().wait()
 
 
 if __name__ == "__main__":